@@ -1,171 +1,274 @@
 #!/bin/env python3
 
-import argparse
-import datetime
 import os
+import secrets
+import selectors
+import shlex
 import signal
 import subprocess
-import threading
+import sys
 import time
 
-# Initialize parser
-parser = argparse.ArgumentParser(
-    prog="Swarm-Exec",
-    description="Execute a command on all nodes in Docker Swarm mode.",
-    add_help=True,
-)
-parser.add_argument(
-    "--rm", action="store_true", help="Remove the container after execution."
-)
-parser.add_argument(
-    "--logs", action="store_true", help="Show the logs of the container."
-)
-parser.add_argument("command", type=str, help="Command to execute on swarm nodes.")
-parser.add_argument(
-    "--mode",
-    type=str,
-    choices=["global", "replicated"],
-    default="global",
-    help="Mode of the service.",
-)
-parser.add_argument(
-    "-q", "--quiet", action="store_true", help="Do not print the command template."
-)
-parser.add_argument(
-    "-v", "--verbose", action="store_true", help="Enable verbose output."
-)
-
-
-def exec_command(command: str, /, *, print_output: bool = True) -> str:
-    """Run a command asynchronously, returning output or error lines."""
+# Printed by every task once its command exits; scanned for as raw bytes.
+SENTINEL = b"DOCKER_SWARM_COMMAND_STATUS="
+
+
+def _build_parser():
+    """Build the CLI parser on demand, keeping argparse off the import path."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="Swarm-Exec",
+        description="Execute a command on all nodes in Docker Swarm mode.",
+        add_help=True,
+    )
+    parser.add_argument(
+        "--rm", action="store_true", help="Remove the container after execution."
+    )
+    parser.add_argument(
+        "--logs", action="store_true", help="Show the logs of the container."
+    )
+    parser.add_argument("command", type=str, help="Command to execute on swarm nodes.")
+    parser.add_argument(
+        "--mode",
+        type=str,
+        choices=["global", "replicated"],
+        default="global",
+        help="Mode of the service.",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="Do not print the command template."
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Enable verbose output."
+    )
+    return parser
+
+
+def exec_command(command: list[str], /, *, print_output: bool = True) -> str:
+    """Run a command, draining stdout and stderr from a single selector loop."""
     process = subprocess.Popen(
         command,
-        shell=True,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        universal_newlines=True,
     )
 
-    output: str = ""
+    chunks: list[bytes] = []
 
-    def stream_output(pipe, prefix):
-        """Stream output from stdout or stderr asynchronously."""
-        nonlocal output
+    sel = selectors.DefaultSelector()
+    for pipe, prefix, out in (
+        (process.stdout, b"OUT: ", sys.stdout.buffer),
+        (process.stderr, b"ERR: ", sys.stderr.buffer),
+    ):
+        if pipe:
+            os.set_blocking(pipe.fileno(), False)
+            sel.register(pipe, selectors.EVENT_READ, (prefix, out))
 
-        for line in iter(pipe.readline, ""):
-            output += line
-            print(f"{prefix}: {line}", end="")
-        pipe.close()
-
-    if print_output:
-        if process.stdout:
-            threading.Thread(target=stream_output, args=(process.stdout, "OUT")).start()
-        if process.stderr:
-            threading.Thread(target=stream_output, args=(process.stderr, "ERR")).start()
+    while sel.get_map():
+        for key, _ in sel.select():
+            chunk = os.read(key.fd, 65536)
+            if not chunk:
+                sel.unregister(key.fileobj)
+                continue
+            chunks.append(chunk)
+            if print_output:
+                prefix, out = key.data
+                out.write(prefix + chunk)
+                out.flush()
+    sel.close()
 
-    # Wait for the command to complete without blocking the main thread
     return_code = process.wait()
     if return_code != 0:
         raise subprocess.CalledProcessError(return_code, command)
 
-    return output
+    return b"".join(chunks).decode()
 
 
 def number_of_replicas(service_name: str) -> int:
-    return int(
-        subprocess.check_output(
-            'docker service ls --filter "name=%s" --filter "mode=global" --format "{{.Replicas}}" | cut -d"/" -f2'
-            % service_name,
-            shell=True,
+    replicas = subprocess.check_output(
+        [
+            "docker",
+            "service",
+            "inspect",
+            "--format",
+            "{{if .Spec.Mode.Global}}global"
+            "{{else}}{{.Spec.Mode.Replicated.Replicas}}{{end}}",
+            service_name,
+        ],
+        universal_newlines=True,
+    ).strip()
+    if replicas == "global":
+        # A global service runs one task per schedulable node: down or
+        # drained nodes never receive a task and must not be counted.
+        nodes = subprocess.check_output(
+            ["docker", "node", "ls", "--format", "{{.Status}} {{.Availability}}"],
             universal_newlines=True,
         )
-    )
+        return nodes.splitlines().count("Ready Active")
+    return int(replicas)
 
 
-def output_container_logs(container_name: str, /, *, logs: bool = True) -> None:
-    """Continuously checks logs for DOCKER_SWARM_COMMAND_STATUS=1 in container logs."""
-    command = f"docker service logs {container_name} --follow"
-    process = subprocess.Popen(
-        command, shell=True, stdout=subprocess.PIPE, universal_newlines=True
+def output_container_logs(container_name: str, /) -> None:
+    """Wait until every replica signals completion, multiplexing the swarm
+    event stream with the service logs."""
+    events_process = subprocess.Popen(
+        [
+            "docker",
+            "events",
+            "--filter",
+            "scope=swarm",
+            "--filter",
+            f"service={container_name}",
+            "--format",
+            "{{.Status}} {{.Actor.Attributes.name}}",
+        ],
+        stdout=subprocess.PIPE,
     )
 
+    logs_process = subprocess.Popen(
+        ["docker", "service", "logs", container_name, "--follow", "--no-trunc"],
+        stdout=subprocess.PIPE,
+    )
+
+    completed_tasks: int = 0
     finished: int = 0
 
     replicas = number_of_replicas(container_name)
-    if process.stdout:
-        for line in iter(process.stdout.readline, ""):
-            if f"DOCKER_SWARM_COMMAND_STATUS=1" in line:
-                finished += 1
-            elif logs:
-                print(f"LOG: {line}", end="")
-
-            if finished >= replicas:
-                print("Command finished.")
-                process.terminate()
-                break
 
-        process.stdout.close()
+    sel = selectors.DefaultSelector()
+    events_buffer = bytearray()
+    # Holds the last len(SENTINEL) - 1 log bytes so a sentinel split across
+    # two chunks is still counted exactly once.
+    log_tail = b""
+    for process in (events_process, logs_process):
+        if process.stdout:
+            os.set_blocking(process.stdout.fileno(), False)
+            sel.register(process.stdout, selectors.EVENT_READ)
 
-    process.wait()
+    # Log chunks bypass the buffered text layer below, so drain it first.
+    sys.stdout.flush()
+
+    while sel.get_map() and max(finished, completed_tasks) < replicas:
+        for key, _ in sel.select():
+            chunk = os.read(key.fd, 1 << 20)
+            if not chunk:
+                sel.unregister(key.fileobj)
+                continue
+            if key.fileobj is events_process.stdout:
+                # One state-transition record per task, no log payload.
+                events_buffer += chunk
+                *lines, events_buffer[:] = events_buffer.split(b"\n")
+                completed_tasks += sum(
+                    line.startswith(b"complete") for line in lines
+                )
+            else:
+                # bytes.count dispatches to memmem; no str decode, no lines.
+                log_tail += chunk
+                finished += log_tail.count(SENTINEL)
+                log_tail = log_tail[1 - len(SENTINEL) :]
+                os.write(sys.stdout.fileno(), chunk)
+    sel.close()
+
+    print("Command finished.")
+    for process in (events_process, logs_process):
+        process.terminate()
+        process.wait()
 
 
 def main():
-    inputs = parser.parse_args()
-    now = datetime.datetime.now(datetime.timezone.utc)
+    inputs = _build_parser().parse_args()
     container_name = (
-        f"swarm-exec_{now.strftime('%Y-%m-%d_%H%M%S')}_{os.urandom(4).hex()}"
+        f"swarm-exec_{time.strftime('%Y-%m-%d_%H%M%S', time.gmtime())}"
+        f"_{secrets.token_hex(4)}"
     )
 
-    command_template = f"""
-docker service create \
-    --name {container_name} \
-    --mode {inputs.mode} \
-    --cap-add=ALL \
-    --mount type=bind,source=/var/run/docker.sock,target=/var/run/docker.sock \
-    --restart-condition none \
-    docker:cli sh -c "{inputs.command} ; echo DOCKER_SWARM_COMMAND_STATUS=1 && while true; do sleep 3600; done"
-"""
-
-    # Register the cleanup function.
-    def cleanup(signum, frame):
-        """Cleanup function called on SIGINT and SIGTERM signals."""
-        if inputs.verbose:
-            print("Cleaning up...")
-        exec_command(
-            f"docker service rm {container_name}", print_output=not inputs.quiet
-        )
-        exit(0)
+    command_template = [
+        "docker",
+        "service",
+        "create",
+        "--name",
+        container_name,
+        "--mode",
+        inputs.mode,
+        "--cap-add=ALL",
+        "--mount",
+        "type=bind,source=/var/run/docker.sock,target=/var/run/docker.sock",
+        "--restart-condition",
+        "none",
+        "docker:cli",
+        "sh",
+        "-c",
+        f"{inputs.command} ; rc=$?"
+        "; printf 'DOCKER_SWARM_COMMAND_STATUS=%s\\n' \"$rc\""
+        "; exec sleep infinity",
+    ]
+
+    rm_command = ["docker", "service", "rm", container_name]
+    removed = False
+
+    def remove_service():
+        """Remove the service, at most once per run."""
+        nonlocal removed
+        if removed:
+            return
+        removed = True
+        exec_command(rm_command, print_output=not inputs.quiet)
 
-    signal.signal(signal.SIGINT, cleanup)
-    signal.signal(signal.SIGTERM, cleanup)
+    # The handler does no work of its own: it only unwinds whatever wait the
+    # main thread is blocked in, and cleanup runs below with the handlers
+    # already reset to their defaults.
+    def request_shutdown(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGTERM, request_shutdown)
 
     if inputs.verbose:
         print("#" * 80)
         print(f"Executing command: {inputs.command}")
         print("#" * 80)
-        print(f"Template command:\n{command_template}", end="")
+        print(f"Template command:\n{shlex.join(command_template)}")
         print("#" * 80)
 
+    interrupted = False
     try:
-        # Run the command template asynchronously
-        exec_command(command_template, print_output=not inputs.quiet)
-    except subprocess.CalledProcessError as e:
-        print(e)
+        try:
+            # Run the command template asynchronously
+            exec_command(command_template, print_output=not inputs.quiet)
+        except subprocess.CalledProcessError as e:
+            print(e)
 
-    # Check the container logs until DOCKER_SWARM_COMMAND_STATUS=1 is detected
-    if inputs.logs:
-        if inputs.verbose:
-            print(f"Waiting for command to finish in container: {container_name}")
-        output_container_logs(container_name, logs=inputs.logs)
+        # Follow the container logs until the sentinel is detected
+        if inputs.logs:
+            if inputs.verbose:
+                print(f"Waiting for command to finish in container: {container_name}")
+            output_container_logs(container_name)
+    except KeyboardInterrupt:
+        interrupted = True
+    finally:
+        # From here on a second signal should terminate the process outright.
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
-    # Remove the container if specified
-    if inputs.rm:
-        time.sleep(1)
+    if interrupted:
+        if inputs.verbose:
+            print("Cleaning up...")
+        remove_service()
+    elif inputs.rm:
+        # The service is normally registered by the time create returns;
+        # poll briefly instead of always paying a fixed one-second pause.
+        for _ in range(10):
+            registered = subprocess.call(
+                ["docker", "service", "inspect", container_name, "--format", "{{.ID}}"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            if registered == 0:
+                break
+            time.sleep(0.05)
         if inputs.verbose:
             print(f"Removing container: {container_name}")
-        exec_command(
-            f"docker service rm {container_name}", print_output=not inputs.quiet
-        )
+        remove_service()
 
 
 if __name__ == "__main__":